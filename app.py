@@ -1,10 +1,11 @@
 import os
 import io
+import shutil
 import time
 import zipfile
 import random
 import json
-from flask import Flask, request, jsonify, send_from_directory, send_file
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from PIL import Image
@@ -21,8 +22,10 @@ CORS(app, origins=["http://localhost:3000", "http://127.0.0.1:3000"])
 UPLOAD_FOLDER = 'uploads'
 PIECES_FOLDER = 'pieces'
 REBUILT_FOLDER = 'rebuilt'
+CACHE_FOLDER = 'cache'
 ALLOWED_EXTENSIONS = {'png'}
 SHUFFLE_ORDER_FILE = os.path.join(PIECES_FOLDER, "pieces_order.json")
+UPLOAD_CHUNK_SIZE = 1 << 20  # copy uploads to disk in 1 MB chunks
 
 # Make sure the directories exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -39,6 +42,16 @@ def allowed_file(filename):
     """Check if uploaded file has an allowed extension."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def list_pngs(folder):
+    """Return the PNG filenames in a folder, sorted."""
+    with os.scandir(folder) as it:
+        return sorted(e.name for e in it if e.name.endswith('.png') and e.is_file())
+
+def _reset_dir(path):
+    """Remove a folder with everything in it and recreate it empty."""
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
 # ---------------- Shatter Route ----------------
 @app.route('/shatter', methods=['POST'])
 def shatter():
@@ -54,20 +67,14 @@ def shatter():
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
         upload_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(upload_path)
-        
-        # Clear existing pieces folder before shattering
-        for f in os.listdir(PIECES_FOLDER):
-            if f.endswith('.png'):
-                os.remove(os.path.join(PIECES_FOLDER, f))
-        if os.path.exists(SHUFFLE_ORDER_FILE):
-            os.remove(SHUFFLE_ORDER_FILE)
+        with open(upload_path, 'wb') as out:
+            shutil.copyfileobj(file.stream, out, length=UPLOAD_CHUNK_SIZE)
         
-        # Run the shatter algorithm
-        shatter_jigsaw_interlocking(upload_path, output_dir=PIECES_FOLDER)
+        # Clear existing pieces folder (pieces, edges, shuffle order) before shattering
+        _reset_dir(PIECES_FOLDER)
         
-        # List the generated pieces
-        pieces = sorted([f for f in os.listdir(PIECES_FOLDER) if f.endswith('.png')])
+        # Run the shatter algorithm; it returns the generated piece names in order
+        pieces = shatter_jigsaw_interlocking(upload_path, output_dir=PIECES_FOLDER)
         piece_urls = [f'/static/pieces/{p}' for p in pieces]
         return jsonify({'pieces': piece_urls, 'runtime': time.time()-total_start})
     
@@ -80,9 +87,8 @@ def rebuild():
     total_start = time.time()
     
     # Clear rebuilt folder
-    for f in os.listdir(REBUILT_FOLDER):
-        if f.endswith('.png'):
-            os.remove(os.path.join(REBUILT_FOLDER, f))
+    for f in list_pngs(REBUILT_FOLDER):
+        os.remove(os.path.join(REBUILT_FOLDER, f))
     
     try:
         output_path = os.path.join(REBUILT_FOLDER, 'reconstructed.png')
@@ -91,7 +97,8 @@ def rebuild():
         assembled = rebuild_jigsaw(
             pieces_folder=PIECES_FOLDER, 
             edges_file=os.path.join(PIECES_FOLDER, 'pieces_edges.json'),
-            output_path=output_path
+            output_path=output_path,
+            cache_dir=CACHE_FOLDER
         )
         
         rebuilt_url = '/static/rebuilt/reconstructed.png'
@@ -113,7 +120,7 @@ def rebuild():
 @app.route('/shuffle_pieces', methods=['POST'])
 def shuffle_pieces():
     """Randomly shuffle the pieces and save the order."""
-    pieces = [f for f in os.listdir(PIECES_FOLDER) if f.endswith('.png')]
+    pieces = list_pngs(PIECES_FOLDER)
     if not pieces:
         return jsonify({'error': 'No pieces to shuffle'}), 400
 
@@ -135,7 +142,7 @@ def load_pieces():
         with open(SHUFFLE_ORDER_FILE, 'r') as f:
             pieces = json.load(f)
     else:
-        pieces = sorted([f for f in os.listdir(PIECES_FOLDER) if f.endswith('.png')])
+        pieces = list_pngs(PIECES_FOLDER)
     
     piece_urls = [f'/static/pieces/{p}' for p in pieces]
     return jsonify({'pieces': piece_urls})
@@ -156,9 +163,8 @@ def load_zip_pieces():
     
     try:
         # Clear existing pieces & shuffle file
-        for f in os.listdir(PIECES_FOLDER):
-            if f.endswith('.png'):
-                os.remove(os.path.join(PIECES_FOLDER, f))
+        for f in list_pngs(PIECES_FOLDER):
+            os.remove(os.path.join(PIECES_FOLDER, f))
         if os.path.exists(SHUFFLE_ORDER_FILE):
             os.remove(SHUFFLE_ORDER_FILE)
         
@@ -175,7 +181,7 @@ def load_zip_pieces():
                     if os.path.exists(extracted_path):
                         os.rename(extracted_path, new_path)
         
-        pieces = sorted([f for f in os.listdir(PIECES_FOLDER) if f.endswith('.png')])
+        pieces = list_pngs(PIECES_FOLDER)
         piece_urls = [f'/static/pieces/{p}' for p in pieces]
         return jsonify({'pieces': piece_urls, 'runtime': time.time()-total_start})
     
@@ -185,16 +191,40 @@ def load_zip_pieces():
         return jsonify({'error': f'Error processing zip: {str(e)}'}, 500)
 
 # ---------------- Download Pieces as Zip ----------------
+class _ZipChunkSink(io.RawIOBase):
+    """Write-only, unseekable sink that collects zip bytes until drained."""
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
 @app.route('/download_pieces_zip', methods=['GET'])
 def download_pieces_zip():
-    """Download all pieces as a zip archive."""
-    mem_zip = io.BytesIO()
-    with zipfile.ZipFile(mem_zip, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for filename in sorted(os.listdir(PIECES_FOLDER)):
-            file_path = os.path.join(PIECES_FOLDER, filename)
-            zf.write(file_path, arcname=filename)
-    mem_zip.seek(0)
-    return send_file(mem_zip, mimetype='application/zip', as_attachment=True, download_name='pieces.zip')
+    """Download all pieces as a zip archive, streamed file by file."""
+    filenames = sorted(os.listdir(PIECES_FOLDER))
+
+    def generate():
+        sink = _ZipChunkSink()
+        # PNGs are already deflated, so store them as-is instead of re-compressing
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zf:
+            for filename in filenames:
+                zf.write(os.path.join(PIECES_FOLDER, filename), arcname=filename)
+                yield sink.drain()
+        # Central directory is written on close
+        yield sink.drain()
+
+    return Response(generate(), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename=pieces.zip'})
 
 # ---------------- Serve Static ----------------
 @app.route('/static/pieces/<path:filename>')
@@ -214,5 +244,6 @@ def test():
     return 'CORS is working!'
 
 # ---------------- Main ----------------
+# Development server only; run under gunicorn in production (see README)
 if __name__ == '__main__':
     app.run(debug=False, threaded=True, host='127.0.0.1', port=5001)
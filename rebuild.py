@@ -1,21 +1,202 @@
 # rebuild.py
 import os
+import io
 import json
+import hashlib
+import tempfile
+import zipfile
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from skimage import color
 
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional: without it the solver below runs as plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
+try:
+    import pyspng
+except ImportError:
+    pyspng = None  # optional faster PNG decoder; Pillow is used otherwise
+
 # ---------------- Configuration ----------------
 ROWS = 5
 COLS = 10
 TAB_RADIUS = 20        # same tab radius as used in shatter.py
 COLOR_SAMPLE = 20      # number of pixels sampled along edge for color matching
 TOP_CANDIDATES = 5     # only try the top N candidates by color score first
+PNG_COMPRESS_LEVEL = 1 # zlib level for the reconstructed PNG (1 = fastest encode)
+SIGNATURE_CACHE = "edge_sigs.npz"   # cache of LAB edge signatures, kept in cache_dir
+EDGE_SIDES = ('top', 'bottom', 'left', 'right')
+
+# Shared pool for piece file loading, reused across rebuilds. Decoding is the
+# only stage that releases the GIL for long, so one thread per core suffices;
+# CPU-bound stages are batched numpy instead of threaded.
+_LOAD_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# ---------------- Piece decoding ----------------
+def _decode_rgba(data):
+    """Decode PNG bytes into an RGBA uint8 array, using pyspng when it is installed."""
+    if pyspng is not None:
+        try:
+            arr = pyspng.load(data)
+        except (RuntimeError, ValueError):
+            arr = None  # formats pyspng can't read, e.g. grayscale+alpha
+        if arr is not None and arr.ndim == 3 and arr.shape[2] == 4 and arr.dtype == np.uint8:
+            return arr
+    # Pillow fallback, also used for non-RGBA or 16-bit pieces
+    im = Image.open(io.BytesIO(data))
+    im.load()
+    if im.mode != "RGBA":
+        im = im.convert("RGBA")
+    return np.asarray(im)
+
+def _read_piece(path):
+    """Read a piece file, returning its content digest and decoded RGBA array."""
+    with open(path, "rb") as f:
+        data = f.read()
+    return hashlib.blake2b(data, digest_size=16).hexdigest(), _decode_rgba(data)
+
+# ---------------- Signature cache ----------------
+def _load_signature_cache(path):
+    """Load cached edge signatures as {key: array}; a missing or unreadable cache is empty."""
+    try:
+        with np.load(path) as cache:
+            return {key: cache[key] for key in cache.files}
+    except (OSError, ValueError, zipfile.BadZipFile):
+        return {}
+
+def _save_signature_cache(path, entries):
+    """
+    Write the signature cache atomically so concurrent rebuilds never read a
+    partial file. The cache is only an optimization, so a failed write is
+    skipped (and its temp file removed) rather than raised.
+    """
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # unique temp name per writer, so concurrent rebuilds never share one
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or ".", suffix=".tmp",
+                                         delete=False) as f:
+            tmp_path = f.name
+            np.savez(f, **entries)
+        os.replace(tmp_path, path)
+    except OSError:
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+# ---------------- Solver kernel ----------------
+N_PATTERNS = 81        # edge patterns: 4 sides x {-1, 1, 2}
+
+@njit(cache=True)
+def _pattern_key(top, right, bottom, left):
+    """Pack a [top, right, bottom, left] edge pattern into 0..80, or -1 if any value is not -1/1/2."""
+    key = 0
+    for v in (top, right, bottom, left):
+        if v == -1:
+            code = 0
+        elif v == 1:
+            code = 1
+        elif v == 2:
+            code = 2
+        else:
+            return -1
+        key = key*3 + code
+    return key
+
+@njit(cache=True)
+def _solve(edges, D_tb, D_rl, bucket_start, bucket_members, rows, cols, top_k):
+    """
+    Backtracking placement over cells in row-major order, using an explicit stack.
+    Pieces are bucketed by edge pattern: bucket_members[bucket_start[k]:bucket_start[k+1]]
+    are the pieces whose pattern key is k, in ascending index order.
+    Returns the piece index per cell, or an empty array if no solution exists.
+    """
+    n_cells = rows*cols
+    n = edges.shape[0]
+    placed = np.full(n_cells, -1, np.int64)
+    used = np.zeros(n, np.bool_)
+    ranked = np.empty((n_cells, top_k), np.int64)  # candidates to try per cell
+    n_ranked = np.zeros(n_cells, np.int64)
+    tried = np.zeros(n_cells, np.int64)
+    valids = np.empty(n, np.int64)
+    scores = np.empty(n, np.float64)
+    flat_only = np.array([2], np.int64)
+    tab_or_slot = np.array([-1, 1], np.int64)
+
+    idx = 0
+    entering = True
+    while idx < n_cells:
+        r = idx // cols
+        c = idx % cols
+        if entering:
+            # top/left are fixed by placed neighbors or the border,
+            # bottom/right only need to be flat exactly on the border
+            top = 2 if r==0 else -edges[placed[idx-cols], 2]
+            left = 2 if c==0 else -edges[placed[idx-1], 1]
+            bottoms = flat_only if r==rows-1 else tab_or_slot
+            rights = flat_only if c==cols-1 else tab_or_slot
+            # collect unused pieces from every matching bucket
+            n_valid = 0
+            for bottom in bottoms:
+                for right in rights:
+                    key = _pattern_key(top, right, bottom, left)
+                    if key < 0:
+                        continue
+                    for k in range(bucket_start[key], bucket_start[key+1]):
+                        p = bucket_members[k]
+                        if not used[p]:
+                            valids[n_valid] = p
+                            n_valid += 1
+            # restore index order across buckets, then score against placed neighbors
+            cands = np.sort(valids[:n_valid])
+            for k in range(n_valid):
+                p = cands[k]
+                score = 0.0
+                if r>0:
+                    score += D_tb[placed[idx-cols], p]
+                if c>0:
+                    score += D_rl[placed[idx-1], p]
+                scores[k] = score
+            # sort by color similarity (smaller score = better match), stable on ties
+            order = np.argsort(scores[:n_valid], kind='mergesort')
+            m = min(n_valid, top_k)
+            for k in range(m):
+                ranked[idx, k] = cands[order[k]]
+            n_ranked[idx] = m
+            tried[idx] = 0
+        else:
+            # back from a failed subtree: undo this cell's placement
+            used[placed[idx]] = False
+            placed[idx] = -1
+
+        if tried[idx] < n_ranked[idx]:
+            p = ranked[idx, tried[idx]]
+            tried[idx] += 1
+            placed[idx] = p
+            used[p] = True
+            idx += 1
+            entering = True
+        elif idx == 0:
+            return np.empty(0, np.int64)
+        else:
+            idx -= 1
+            entering = False
+    return placed
 
 def rebuild_jigsaw(pieces_folder="pieces",
                    edges_file="pieces/pieces_edges.json",
                    output_path="rebuilt/reconstructed.png",
-                   shuffle_file="pieces/pieces_order.json"):
+                   shuffle_file="pieces/pieces_order.json",
+                   cache_dir="cache"):
 
     # ---------------- Load piece edge definitions ----------------
     # Each piece has a list of 4 edge values: [top, right, bottom, left]
@@ -24,21 +205,23 @@ def rebuild_jigsaw(pieces_folder="pieces",
         piece_edges = json.load(f)
 
     # ---------------- Load piece images ----------------
-    piece_map = {}
-    for fname in os.listdir(pieces_folder):
-        if fname.endswith(".png"):
-            piece_map[fname] = Image.open(os.path.join(pieces_folder, fname)).convert("RGBA")
+    # Pieces are decoded once and kept as RGBA arrays. Each file is hashed as
+    # it is read; the digest keys the signature cache.
+    fnames = [f for f in os.listdir(pieces_folder) if f.endswith(".png")]
+    loaded = list(_LOAD_POOL.map(_read_piece, (os.path.join(pieces_folder, f) for f in fnames)))
+    piece_hash = {fname: digest for fname, (digest, _) in zip(fnames, loaded)}
+    piece_map = {fname: arr for fname, (_, arr) in zip(fnames, loaded)}
     if not piece_map:
         raise ValueError("No pieces found")
 
     # ---------------- Determine piece dimensions ----------------
     sample_img = next(iter(piece_map.values()))
-    pw, ph = sample_img.size
+    ph, pw = sample_img.shape[:2]
     # remove tab margins to get actual puzzle piece area
     pw -= 2 * TAB_RADIUS
     ph -= 2 * TAB_RADIUS
     # create blank canvas large enough to hold full reconstructed image
-    canvas = Image.new("RGBA", (COLS*pw + 2*TAB_RADIUS, ROWS*ph + 2*TAB_RADIUS), (255,255,255,255))
+    canvas = np.full((ROWS*ph + 2*TAB_RADIUS, COLS*pw + 2*TAB_RADIUS, 4), 255, dtype=np.uint8)
 
     # ---------------- Load shuffle order if exists ----------------
     if os.path.exists(shuffle_file):
@@ -47,139 +230,116 @@ def rebuild_jigsaw(pieces_folder="pieces",
     else:
         shuffle_order = list(piece_map.keys())
 
-    # ---------------- Categorize pieces ----------------
-    # Corner pieces have 2 flat edges, edge pieces have 1 flat, interior none
-    corner_pieces = []
-    edge_pieces = []
-    interior_pieces = []
-    for name in shuffle_order:
-        e = piece_edges[name]
-        flat = e.count(2)
-        if flat == 2:
-            corner_pieces.append(name)
-        elif flat == 1:
-            edge_pieces.append(name)
-        else:
-            interior_pieces.append(name)
+    # Pieces are referred to by their position in the shuffle order from here on
+    names = list(shuffle_order)
+    n = len(names)
 
     # ---------------- Precompute LAB color signatures for edges ----------------
-    # This allows fast color comparisons during placement
-    def extract_edge_signature(img, direction):
-        """Sample pixels along a piece edge and convert to LAB color space."""
-        img = img.copy()
-        if direction == 'top':
-            edge = img.crop((TAB_RADIUS, TAB_RADIUS, TAB_RADIUS+pw, TAB_RADIUS+COLOR_SAMPLE))
-        elif direction == 'bottom':
-            edge = img.crop((TAB_RADIUS, TAB_RADIUS+ph-COLOR_SAMPLE, TAB_RADIUS+pw, TAB_RADIUS+ph))
-        elif direction == 'left':
-            edge = img.crop((TAB_RADIUS, TAB_RADIUS, TAB_RADIUS+COLOR_SAMPLE, TAB_RADIUS+ph))
-        elif direction == 'right':
-            edge = img.crop((TAB_RADIUS+pw-COLOR_SAMPLE, TAB_RADIUS, TAB_RADIUS+pw, TAB_RADIUS+ph))
-        arr = np.array(edge)[:,:,:3]          # drop alpha channel
-        arr = arr.reshape(-1,3) / 255.0      # normalize to 0..1
-        lab = color.rgb2lab(arr[np.newaxis,:,:])  # convert to LAB
-        return lab[0]
-
-    # Compute LAB signatures for all pieces & all edges
-    edge_sigs = {}
-    for name, img in piece_map.items():
-        edge_sigs[name] = {
-            'top': extract_edge_signature(img, 'top'),
-            'bottom': extract_edge_signature(img, 'bottom'),
-            'left': extract_edge_signature(img, 'left'),
-            'right': extract_edge_signature(img, 'right'),
-        }
+    # This allows fast color comparisons during placement. Each edge band is
+    # cropped from the padded piece at (y0, y1, x0, x1), so bands of pieces
+    # thinner than COLOR_SAMPLE reach into the tab margin as a PIL crop would
+    T = TAB_RADIUS
+    band_boxes = {
+        'top': (T, T+COLOR_SAMPLE, T, T+pw),
+        'bottom': (T+ph-COLOR_SAMPLE, T+ph, T, T+pw),
+        'left': (T, T+ph, T, T+COLOR_SAMPLE),
+        'right': (T, T+ph, T+pw-COLOR_SAMPLE, T+pw),
+    }
+    def crop_bands(side, rows):
+        """Stack one edge band of the given pieces as (len(rows), h, w, 3) uint8, zero-padding past the piece."""
+        y0, y1, x0, x1 = band_boxes[side]
+        out = np.zeros((len(rows), y1-y0, x1-x0, 3), dtype=np.uint8)
+        for j, i in enumerate(rows):
+            part = piece_map[names[i]][max(y0, 0):y1, max(x0, 0):x1, :3]
+            oy, ox = max(-y0, 0), max(-x0, 0)
+            out[j, oy:oy+part.shape[0], ox:ox+part.shape[1]] = part
+        return out
 
-    # ---------------- Placement data ----------------
-    placed = {}  # (row,col) -> piece name
-    used = set() # track which pieces are already placed
-
-    # ---------------- Validity check ----------------
-    def is_valid(name, r, c):
-        """Check if a piece can be placed at (r,c) considering neighbor edges and borders."""
-        e = piece_edges[name]
-        # top neighbor must match
-        if r>0:
-            top = placed[(r-1,c)]
-            if e[0] != -piece_edges[top][2]:
-                return False
-        # left neighbor must match
-        if c>0:
-            left = placed[(r,c-1)]
-            if e[3] != -piece_edges[left][1]:
-                return False
-        # enforce border flat edges
-        if r==0 and e[0]!=2: return False
-        if r==ROWS-1 and e[2]!=2: return False
-        if c==0 and e[3]!=2: return False
-        if c==COLS-1 and e[1]!=2: return False
-        return True
-
-    # ---------------- Color scoring ----------------
-    def color_score(name, r, c):
-        """Compute color difference between candidate piece and its neighbors."""
-        score = 0.0
-        # top neighbor
-        if r>0:
-            top_name = placed[(r-1,c)]
-            score += np.mean((edge_sigs[name]['top'] - edge_sigs[top_name]['bottom'])**2)
-        # left neighbor
-        if c>0:
-            left_name = placed[(r,c-1)]
-            score += np.mean((edge_sigs[name]['left'] - edge_sigs[left_name]['right'])**2)
-        return score
-
-    # ---------------- Next empty cell ----------------
-    def next_cell():
-        """Return the next empty (row,col) cell to fill."""
-        for r in range(ROWS):
-            for c in range(COLS):
-                if (r,c) not in placed:
-                    return r,c
-        return None,None
-
-    # ---------------- Backtracking placement ----------------
-    def backtrack():
-        r,c = next_cell()
-        if r is None:
-            return True  # all cells placed
-        # select candidate list based on piece type
-        is_corner = (r==0 or r==ROWS-1) and (c==0 or c==COLS-1)
-        is_edge = (r==0 or r==ROWS-1 or c==0 or c==COLS-1) and not is_corner
-        if is_corner:
-            candidates = corner_pieces
-        elif is_edge:
-            candidates = edge_pieces
+    def extract_edge_signatures(rows):
+        """Convert a batch of piece edge bands to LAB, flattening each band to one row per piece."""
+        # Crop the uint8 bands first and convert only those, in one rgb2lab
+        # call over the concatenated bands
+        flat = [crop_bands(side, rows).reshape(len(rows), -1, 3) for side in EDGE_SIDES]
+        lab = color.rgb2lab(np.concatenate(flat, axis=1) / np.float32(255.0))
+        ends = np.cumsum([f.shape[1] for f in flat])
+        return {side: part.reshape(len(rows), -1)
+                for side, part in zip(EDGE_SIDES, np.split(lab, ends[:-1], axis=1))}
+
+    # Per side, one (n, band_len*3) array with a row per piece in `names`
+    band_len = {side: (y1-y0)*(x1-x0) for side, (y0, y1, x0, x1) in band_boxes.items()}
+    # float32 halves the memory and cache size; LAB values need nothing wider
+    bands = {side: np.empty((n, band_len[side]*3), dtype=np.float32) for side in EDGE_SIDES}
+
+    # Reuse signatures cached for identical piece files and geometry. The cache
+    # lives outside the pieces folder so it is never served or zipped as a piece
+    cache_path = os.path.join(cache_dir, SIGNATURE_CACHE)
+    cache = _load_signature_cache(cache_path)
+    cache_key = [f"{piece_hash[name]}_{pw}x{ph}x{COLOR_SAMPLE}" for name in names]
+    missing = []
+    for i, key in enumerate(cache_key):
+        if all(f"{key}_{side}" in cache for side in EDGE_SIDES):
+            for side in EDGE_SIDES:
+                bands[side][i] = cache[f"{key}_{side}"].reshape(-1)
         else:
-            candidates = interior_pieces
-        # filter candidates that are valid and not used
-        valids = [n for n in candidates if n not in used and is_valid(n,r,c)]
-        # sort by color similarity (smaller score = better match)
-        ranked = sorted(valids, key=lambda n: color_score(n,r,c))
-        # try top candidates first
-        for name in ranked[:TOP_CANDIDATES]:
-            placed[(r,c)] = name
-            used.add(name)
-            if backtrack():
-                return True
-            # undo if failed
-            del placed[(r,c)]
-            used.remove(name)
-        return False
+            missing.append(i)
+
+    # Compute LAB signatures for the remaining pieces in a single batch
+    if missing:
+        rows = np.array(missing)
+        sigs = extract_edge_signatures(rows)
+        for side in EDGE_SIDES:
+            bands[side][rows] = sigs[side]
+        # only keep entries for the current pieces so the cache doesn't grow
+        _save_signature_cache(cache_path, {
+            f"{key}_{side}": bands[side][i]
+            for i, key in enumerate(cache_key) for side in EDGE_SIDES
+        })
+
+    # ---------------- Pairwise edge distances ----------------
+    def pairwise_distances(A, B):
+        """Mean squared LAB difference between every row of A and every row of B."""
+        # ||a-b||^2 = ||a||^2 + ||b||^2 - 2 a.b, with all cross terms from one GEMM;
+        # float64 keeps the cancellation error far below any real score gap
+        A = A.astype(np.float64)
+        B = B.astype(np.float64)
+        norm_a = np.einsum('ij,ij->i', A, A)
+        norm_b = np.einsum('ij,ij->i', B, B)
+        sq = norm_a[:,None] + norm_b[None,:] - 2.0 * (A @ B.T)
+        return np.maximum(sq, 0.0) / A.shape[1]
+    # D_tb[i,j]: piece i's bottom vs piece j's top (i above j)
+    # D_rl[i,j]: piece i's right vs piece j's left (i left of j)
+    D_tb = pairwise_distances(bands['bottom'], bands['top'])
+    D_rl = pairwise_distances(bands['right'], bands['left'])
+
+    # ---------------- Placement data ----------------
+    # Bucket pieces by [top, right, bottom, left] pattern so each cell only
+    # looks at the few buckets compatible with its neighbors and borders
+    edges = np.array([piece_edges[n] for n in names], dtype=np.int64)
+    keys = np.array([_pattern_key(*e) for e in edges], dtype=np.int64)
+    order = np.argsort(keys, kind='stable')
+    bucket_members = order[keys[order] >= 0]
+    bucket_start = np.searchsorted(keys[bucket_members], np.arange(N_PATTERNS+1))
 
     # ---------------- Solve puzzle ----------------
-    solved = backtrack()
-    if not solved:
+    placed = _solve(edges, D_tb, D_rl, bucket_start, bucket_members, ROWS, COLS, TOP_CANDIDATES)
+    if len(placed) == 0:
         raise ValueError("No valid solution")
 
     # ---------------- Paste pieces onto canvas ----------------
-    for (r,c), name in placed.items():
-        canvas.paste(piece_map[name], (c*pw,r*ph), piece_map[name])
+    # Piece alpha is either fully opaque or fully transparent, so copying the
+    # opaque pixels matches an alpha-composited paste
+    canvas_h, canvas_w = canvas.shape[:2]
+    for idx, p in enumerate(placed):
+        r, c = divmod(idx, COLS)
+        y, x = r*ph, c*pw
+        piece = piece_map[names[p]][:canvas_h-y, :canvas_w-x]   # clip to canvas like PIL paste
+        opaque = piece[:,:,3] > 0
+        canvas[y:y+piece.shape[0], x:x+piece.shape[1]][opaque] = piece[opaque]
 
     # Save final reconstructed image
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    canvas.save(output_path)
-    return np.array(canvas)
+    Image.fromarray(canvas).save(output_path, compress_level=PNG_COMPRESS_LEVEL)
+    return canvas
 
 # ---------------- Main ----------------
 if __name__=="__main__":
@@ -1,7 +1,11 @@
 import os
+import io
 import random
 import json
-from PIL import Image, ImageDraw, ImageChops
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image, ImageDraw
 import math
 
 # ---------------- Configuration ----------------
@@ -9,86 +13,115 @@ TAB_RADIUS = 20           # radius of puzzle tabs
 ROWS = 5                  # number of rows in the puzzle
 COLS = 10                 # number of columns in the puzzle
 POINTS_PER_TAB = 100      # number of points used to draw smooth tab curves
+PNG_COMPRESS_LEVEL = 1    # zlib level for saved pieces (1 = fastest encode)
+
+# cos/sin of the sample angles along a tab; identical for every tab, so computed once
+_TAB_ANGLES = [math.pi * (i / POINTS_PER_TAB) for i in range(POINTS_PER_TAB + 1)]
+_TAB_COS = np.array([math.cos(a) for a in _TAB_ANGLES])
+_TAB_SIN = np.array([math.sin(a) for a in _TAB_ANGLES])
+
+# edge indices of a grid cell
+TOP, RIGHT, BOTTOM, LEFT = 0, 1, 2, 3
 
 # ---------------- Grid functions ----------------
 def initialize_grid():
     """
-    Initialize the grid of pieces.
-    Each cell has a list of 4 edges: [top, right, bottom, left].
+    Initialize the grid of pieces as a (ROWS, COLS, 4) int8 array.
+    Each cell holds its 4 edges: [top, right, bottom, left].
     Flat borders (2) are applied to the outer edges of the puzzle.
     """
-    grid = [[[0, 0, 0, 0] for _ in range(COLS)] for _ in range(ROWS)]
-    for r in range(ROWS):
-        for c in range(COLS):
-            north = 2 if r == 0 else 0
-            south = 2 if r == ROWS-1 else 0
-            west = 2 if c == 0 else 0
-            east = 2 if c == COLS-1 else 0
-            grid[r][c] = [north, east, south, west]
+    grid = np.zeros((ROWS, COLS, 4), dtype=np.int8)
+    grid[0, :, TOP] = 2
+    grid[-1, :, BOTTOM] = 2
+    grid[:, 0, LEFT] = 2
+    grid[:, -1, RIGHT] = 2
     return grid
 
-def populate_grid(r, c, grid):
+def populate_grid(grid):
     """
-    Recursively assign tabs (-1 = slot, 1 = tab) to each piece's edges.
+    Assign tabs (-1 = slot, 1 = tab) to each piece's edges.
+    Every interior edge is drawn in a single vectorized RNG call (seeded from
+    the random module, so random.seed() still reproduces a layout).
     Ensures adjacent pieces have complementary edges.
     """
-    directions = [(-1,0,0),(0,1,1),(1,0,2),(0,-1,3)]  # (dr,dc,index)
-    for dr, dc, idx in directions:
-        nr, nc = r+dr, c+dc
-        if 0 <= nr < ROWS and 0 <= nc < COLS:
-            if grid[r][c][idx] == 0:
-                val = random.choice([-1,1])  # assign tab or slot
-                grid[r][c][idx] = val
-                opp = (idx+2)%4               # opposite edge index
-                grid[nr][nc][opp] = -val      # complementary edge for neighbor
-                populate_grid(nr,nc,grid)
+    rng = np.random.default_rng(random.getrandbits(64))
+    sides = np.array([-1, 1], dtype=np.int8)
+    horiz = rng.choice(sides, size=(ROWS, COLS-1))  # east edge of (r,c)
+    vert = rng.choice(sides, size=(ROWS-1, COLS))   # south edge of (r,c)
+
+    # only unassigned edges; the neighbor gets the complementary edge
+    free = grid[:, :-1, RIGHT] == 0
+    grid[:, :-1, RIGHT][free] = horiz[free]
+    grid[:, 1:, LEFT][free] = -horiz[free]
+    free = grid[:-1, :, BOTTOM] == 0
+    grid[:-1, :, BOTTOM][free] = vert[free]
+    grid[1:, :, TOP][free] = -vert[free]
 
 # ---------------- Mask creation ----------------
-def create_interlocking_mask(pw, ph, top, bottom, left, right):
+def tab_points(center, radius, direction, invert=False):
+    """
+    Outline points of a semicircular tab (protrusion or slot) along a piece edge,
+    centered on the edge midpoint and starting/ending exactly on the edge.
+    Returned as a flat [x0, y0, x1, y1, ...] list for ImageDraw.polygon.
+    """
+    # bottom/right tabs sweep and bulge in the positive direction, top/left in
+    # the negative one; inverting (a slot) flips only the bulge
+    sign = 1 if direction in ('bottom', 'right') else -1
+    bulge = -sign if invert else sign
+    along = sign * radius * _TAB_COS
+    across = bulge * radius * _TAB_SIN
+    if direction in ('top', 'bottom'):
+        dx, dy = along, across
+    else:
+        dx, dy = across, along
+    points = np.column_stack([center[0] + dx, center[1] + dy])
+
+    # ensure tab starts and ends at rectangle border
+    if direction in ('top', 'bottom'):
+        points[0] = (center[0] + sign*radius, center[1])
+        points[-1] = (center[0] - sign*radius, center[1])
+    else:
+        points[0] = (center[0], center[1] - sign*radius)
+        points[-1] = (center[0], center[1] + sign*radius)
+    return points.ravel().tolist()
+
+@functools.lru_cache(maxsize=64)
+def _tab_stamp(direction, invert, fx, fy):
     """
-    Generate a mask for a puzzle piece including tabs.
+    Rasterized tab for an edge midpoint at sub-pixel offset (fx, fy), 0 <= fx, fy < 1.
+    Tabs of the same orientation only differ by whole-pixel translation, so
+    each one is drawn once. The [0, 0] pixel of the returned boolean array
+    sits TAB_RADIUS + 1 pixels above and left of the midpoint's pixel.
+    """
+    pad = TAB_RADIUS + 1
+    stamp = Image.new("L", (2*pad + 1, 2*pad + 1), 0)
+    ImageDraw.Draw(stamp).polygon(tab_points((fx + pad, fy + pad), TAB_RADIUS, direction, invert), fill=255)
+    return np.asarray(stamp) > 0
+
+def interlocking_alpha(pw, ph, top, bottom, left, right):
+    """
+    Alpha channel (0/255 uint8 array) of a puzzle piece including tabs.
     The mask defines transparent vs opaque areas for cutting the piece.
+    Tabs and slots are combined on a single boolean array.
     """
-    mask = Image.new("L", (pw + 2*TAB_RADIUS, ph + 2*TAB_RADIUS), 0)
-    
-    # base rectangle for the main piece body
-    rect = Image.new("L", mask.size, 0)
-    draw_rect = ImageDraw.Draw(rect)
-    draw_rect.rectangle([TAB_RADIUS, TAB_RADIUS, TAB_RADIUS+pw, TAB_RADIUS+ph], fill=255)
-    mask = ImageChops.add(mask, rect)
+    size = (pw + 2*TAB_RADIUS, ph + 2*TAB_RADIUS)
+    mask = np.zeros((size[1], size[0]), dtype=bool)
 
-    def draw_tab(center, radius, direction, invert=False):
+    # base rectangle for the main piece body (bounds inclusive, like ImageDraw.rectangle)
+    mask[TAB_RADIUS:TAB_RADIUS+ph+1, TAB_RADIUS:TAB_RADIUS+pw+1] = True
+
+    def draw_tab(center, direction, invert=False):
         """
-        Draw a semicircular tab (protrusion or slot) along a piece edge.
+        Place the cached tab (protrusion or slot) stamp for a piece edge.
+        Returns (rows, cols, tab) where tab is the boolean mask for mask[rows, cols].
         """
-        tab_mask = Image.new("L", mask.size, 0)
-        draw_tab = ImageDraw.Draw(tab_mask)
-        points = []
-        for i in range(POINTS_PER_TAB + 1):
-            t = i / POINTS_PER_TAB
-            angle = math.pi * t
-            if direction == 'top':
-                dx = -radius * math.cos(angle)
-                dy = -radius * math.sin(angle) if not invert else radius * math.sin(angle)
-            elif direction == 'bottom':
-                dx = radius * math.cos(angle)
-                dy = radius * math.sin(angle) if not invert else -radius * math.sin(angle)
-            elif direction == 'left':
-                dx = -radius * math.sin(angle) if not invert else radius * math.sin(angle)
-                dy = -radius * math.cos(angle)
-            elif direction == 'right':
-                dx = radius * math.sin(angle) if not invert else -radius * math.sin(angle)
-                dy = radius * math.cos(angle)
-            points.append((center[0] + dx, center[1] + dy))
-
-        # ensure tab starts and ends at rectangle border
-        if direction == 'top': points[0] = (center[0]-radius, center[1]); points[-1] = (center[0]+radius, center[1])
-        if direction == 'bottom': points[0] = (center[0]+radius, center[1]); points[-1] = (center[0]-radius, center[1])
-        if direction == 'left': points[0] = (center[0], center[1]+radius); points[-1] = (center[0], center[1]-radius)
-        if direction == 'right': points[0] = (center[0], center[1]-radius); points[-1] = (center[0], center[1]+radius)
-
-        draw_tab.polygon(points, fill=255)
-        return tab_mask
+        ix, iy = math.floor(center[0]), math.floor(center[1])
+        stamp = _tab_stamp(direction, invert, center[0] - ix, center[1] - iy)
+        x0, y0 = ix - TAB_RADIUS - 1, iy - TAB_RADIUS - 1
+        x1, y1 = x0 + stamp.shape[1], y0 + stamp.shape[0]
+        tab = stamp[max(-y0, 0):stamp.shape[0] - max(y1 - size[1], 0),
+                    max(-x0, 0):stamp.shape[1] - max(x1 - size[0], 0)]
+        return slice(max(y0, 0), min(y1, size[1])), slice(max(x0, 0), min(x1, size[0])), tab
 
     # center positions for each edge
     mid_top = (TAB_RADIUS + pw/2, TAB_RADIUS)
@@ -96,37 +129,129 @@ def create_interlocking_mask(pw, ph, top, bottom, left, right):
     mid_left = (TAB_RADIUS, TAB_RADIUS + ph/2)
     mid_right = (TAB_RADIUS + pw, TAB_RADIUS + ph/2)
 
-    # apply tabs or slots to mask
-    if top == 1:
-        mask = ImageChops.add(mask, draw_tab(mid_top, TAB_RADIUS, 'top', invert=False))
-    elif top == -1:
-        mask = ImageChops.subtract(mask, draw_tab(mid_top, TAB_RADIUS, 'top', invert=True))
-
-    if bottom == 1:
-        mask = ImageChops.add(mask, draw_tab(mid_bottom, TAB_RADIUS, 'bottom', invert=False))
-    elif bottom == -1:
-        mask = ImageChops.subtract(mask, draw_tab(mid_bottom, TAB_RADIUS, 'bottom', invert=True))
+    # apply tabs (union) or slots (difference) to mask
+    for value, center, direction in ((top, mid_top, 'top'), (bottom, mid_bottom, 'bottom'),
+                                     (left, mid_left, 'left'), (right, mid_right, 'right')):
+        if value == 1:
+            rows, cols, tab = draw_tab(center, direction, invert=False)
+            mask[rows, cols] |= tab
+        elif value == -1:
+            rows, cols, tab = draw_tab(center, direction, invert=True)
+            mask[rows, cols] &= ~tab
 
-    if left == 1:
-        mask = ImageChops.add(mask, draw_tab(mid_left, TAB_RADIUS, 'left', invert=False))
-    elif left == -1:
-        mask = ImageChops.subtract(mask, draw_tab(mid_left, TAB_RADIUS, 'left', invert=True))
+    return mask.view(np.uint8) * np.uint8(255)
 
-    if right == 1:
-        mask = ImageChops.add(mask, draw_tab(mid_right, TAB_RADIUS, 'right', invert=False))
-    elif right == -1:
-        mask = ImageChops.subtract(mask, draw_tab(mid_right, TAB_RADIUS, 'right', invert=True))
+def create_interlocking_mask(pw, ph, top, bottom, left, right):
+    """
+    Generate a mask for a puzzle piece including tabs, as an L image.
+    """
+    return Image.fromarray(interlocking_alpha(pw, ph, top, bottom, left, right))
 
-    return mask
+@functools.lru_cache(maxsize=256)
+def _cached_alpha(pw, ph, top, bottom, left, right):
+    """
+    interlocking_alpha, memoized and read-only: most pieces share the same
+    size and only 81 edge patterns exist, so masks repeat a lot.
+    """
+    alpha = interlocking_alpha(pw, ph, top, bottom, left, right)
+    alpha.flags.writeable = False
+    return alpha
 
 # ---------------- Puzzle generation ----------------
-def shatter_jigsaw_interlocking(image_path, output_dir="pieces"):
+def _paste_over_clear(dst, src):
+    """
+    Paste src onto fully transparent dst using src's own alpha as the mask,
+    with the same rounding as Image.paste(im, box, im).
+    """
+    a = src[..., 3:4].astype(np.uint32)
+    tmp = src.astype(np.uint32) * a + 128
+    dst[...] = ((tmp >> 8) + tmp) >> 8
+
+def _build_piece(src, task):
+    """
+    Cut, mask and PNG-encode one piece. src is the RGBA source image as an
+    (H, W, 4) uint8 array; task is (idx, r, c, edges, box) where box is the
+    piece body (x0, y0, x1, y1) in the source image.
+    Returns (piece_name, edges, png_bytes).
+    """
+    idx, r, c, edges, (x0, y0, x1, y1) = task
+    img_h, img_w = src.shape[:2]
+    pw, ph = x1 - x0, y1 - y0
+    top, right, bottom, left = edges
+    T = TAB_RADIUS
+
+    # generate mask including tabs
+    full_mask = _cached_alpha(pw, ph, top, bottom, left, right)
+
+    # create piece canvas and copy main piece body from original image; a
+    # fresh buffer per piece keeps concurrent shatters from sharing pixels
+    piece = np.zeros((ph + 2 * T, pw + 2 * T, 4), dtype=np.uint8)
+    piece[T:T + ph, T:T + pw] = src[y0:y1, x0:x1]
+
+    # paste neighboring protruding tabs (optional, only if tab exists)
+    if top == 1 and r > 0:
+        y = max(y0 - T, 0)
+        _paste_over_clear(piece[0:y0 - y, T:T + pw], src[y:y0, x0:x1])
+    if bottom == 1 and r < ROWS - 1:
+        y = min(y1 + T, img_h)
+        _paste_over_clear(piece[ph + T:ph + T + y - y1, T:T + pw], src[y1:y, x0:x1])
+    if left == 1 and c > 0:
+        x = max(x0 - T, 0)
+        _paste_over_clear(piece[T:T + ph, 0:x0 - x], src[y0:y1, x:x0])
+    if right == 1 and c < COLS - 1:
+        x = min(x1 + T, img_w)
+        _paste_over_clear(piece[T:T + ph, pw + T:pw + T + x - x1], src[y0:y1, x1:x])
+
+    # apply alpha mask to piece to handle transparency around tabs
+    piece[..., 3] = full_mask
+
+    # encode piece; the caller writes it out
+    buf = io.BytesIO()
+    Image.fromarray(piece).save(buf, "PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return f"piece_{idx:03d}.png", list(edges), buf.getvalue()
+
+def _usable_cpus():
+    """Number of CPUs this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # sched_getaffinity is Linux-only
+        return os.cpu_count() or 1
+
+def _write_pieces(results, output_dir):
+    """
+    Write encoded pieces as they arrive, one write() per file, and return
+    the piece_name -> [top, right, bottom, left] mapping.
+    """
+    piece_edges = {}
+    for piece_name, edges, png in results:
+        with open(os.path.join(output_dir, piece_name), "wb") as f:
+            f.write(png)
+        piece_edges[piece_name] = edges
+    return piece_edges
+
+def _read_rgba(image_path):
+    """
+    Decode an image to raw RGBA bytes, returning (data, (width, height)).
+    convert() is skipped when the image is already RGBA, and the decoded
+    image is released on return so only the byte buffer stays alive.
+    """
+    with Image.open(image_path) as im:
+        rgba = im if im.mode == "RGBA" else im.convert("RGBA")
+        return rgba.tobytes(), rgba.size
+
+def shatter_jigsaw_interlocking(image_path, output_dir="pieces", workers=None):
     """
     Shatter an input image into fully interlocking jigsaw pieces.
     Each piece is saved with its RGBA image and edge definitions.
+    Pieces are built and encoded in parallel on `workers` threads (default:
+    one per usable CPU); workers=1 builds them in the calling thread. Files
+    are written from the calling thread.
+    Returns the list of saved piece filenames in row-major order.
     """
-    img = Image.open(image_path).convert("RGBA")
-    img_w, img_h = img.size
+    # one RGBA byte buffer, read by every worker thread
+    data, (img_w, img_h) = _read_rgba(image_path)
+    src = np.frombuffer(data, dtype=np.uint8).reshape(img_h, img_w, 4)
     os.makedirs(output_dir, exist_ok=True)
 
     piece_w = img_w // COLS
@@ -134,71 +259,37 @@ def shatter_jigsaw_interlocking(image_path, output_dir="pieces"):
 
     # initialize piece grid and populate edges with tabs/slots
     grid = initialize_grid()
-    populate_grid(0, 0, grid)
+    populate_grid(grid)
 
     # save final grid layout
     with open(os.path.join(output_dir, "final_grid.json"), "w") as f:
-        json.dump(grid, f, indent=2)
+        json.dump(grid.tolist(), f, indent=2)
 
-    piece_edges = {}  # piece_name -> [top, right, bottom, left]
-
-    idx = 0
+    # one task per piece, in row-major order
+    tasks = []
     for r in range(ROWS):
         for c in range(COLS):
             x0 = c * piece_w
             y0 = r * piece_h
             x1 = (c + 1) * piece_w if c < COLS - 1 else img_w
             y1 = (r + 1) * piece_h if r < ROWS - 1 else img_h
-            pw, ph = x1 - x0, y1 - y0
-
-            top, right, bottom, left = grid[r][c]
-
-            # generate mask including tabs
-            full_mask = create_interlocking_mask(pw, ph, top, bottom, left, right)
-
-            # create piece canvas
-            piece = Image.new("RGBA", (pw + 2 * TAB_RADIUS, ph + 2 * TAB_RADIUS), (0, 0, 0, 0))
-
-            # crop main piece body from original image
-            piece_part = img.crop((x0, y0, x1, y1))
-            body_mask = Image.new("L", piece_part.size, 255)
-            piece.paste(piece_part, (TAB_RADIUS, TAB_RADIUS), body_mask)
-
-            # paste neighboring protruding tabs (optional, only if tab exists)
-            def paste_tab(dir, neighbor_crop, paste_pos):
-                if neighbor_crop.size[0] == 0 or neighbor_crop.size[1] == 0:
-                    return
-                tab_img = Image.new("RGBA", neighbor_crop.size, (0, 0, 0, 0))
-                tab_img.paste(neighbor_crop, (0, 0))
-                piece.paste(tab_img, paste_pos, tab_img)
-
-            if top == 1 and r > 0:
-                crop = img.crop((x0, max(y0 - TAB_RADIUS, 0), x1, y0))
-                paste_tab('top', crop, (TAB_RADIUS, 0))
-            if bottom == 1 and r < ROWS - 1:
-                crop = img.crop((x0, y1, x1, min(y1 + TAB_RADIUS, img_h)))
-                paste_tab('bottom', crop, (TAB_RADIUS, ph + TAB_RADIUS))
-            if left == 1 and c > 0:
-                crop = img.crop((max(x0 - TAB_RADIUS, 0), y0, x0, y1))
-                paste_tab('left', crop, (0, TAB_RADIUS))
-            if right == 1 and c < COLS - 1:
-                crop = img.crop((x1, y0, min(x1 + TAB_RADIUS, img_w), y1))
-                paste_tab('right', crop, (pw + TAB_RADIUS, TAB_RADIUS))
-
-            # apply alpha mask to piece to handle transparency around tabs
-            piece.putalpha(full_mask)
-
-            # save piece
-            piece_name = f"piece_{idx:03d}.png"
-            piece.save(os.path.join(output_dir, piece_name))
-            piece_edges[piece_name] = [top, right, bottom, left]
-            idx += 1
+            tasks.append((len(tasks), r, c, tuple(grid[r, c].tolist()), (x0, y0, x1, y1)))
+
+    # Threads rather than processes: the numpy copies and Pillow's PNG encoder
+    # release the GIL, and a server process is not forked or re-imported per request
+    workers = min(workers or _usable_cpus(), len(tasks))
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            piece_edges = _write_pieces(ex.map(functools.partial(_build_piece, src), tasks), output_dir)
+    else:
+        piece_edges = _write_pieces((_build_piece(src, task) for task in tasks), output_dir)
 
     # save edges mapping
     with open(os.path.join(output_dir, "pieces_edges.json"), "w") as f:
         json.dump(piece_edges, f, indent=2)
 
-    print(f"Saved {idx} fully interlocking pieces to {output_dir}")
+    print(f"Saved {len(piece_edges)} fully interlocking pieces to {output_dir}")
+    return list(piece_edges)
 
 
 # ---------------- Command line support ----------------